@@ -1,3 +1,4 @@
+from sklearn.base import BaseEstimator, ClassifierMixin, clone
 from sklearn.linear_model import LogisticRegression
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.impute import SimpleImputer
@@ -7,8 +8,241 @@ from sklearn.compose import ColumnTransformer
 from sklearn.experimental import enable_halving_search_cv # noqa
 from sklearn.model_selection import HalvingGridSearchCV
 import numpy as np
+import pandas as pd
+import os
+import glob
+import shutil
+import joblib
+import weakref
+from collections import deque
+from contextlib import contextmanager
+from utils import fingerprint
 from tempfile import mkdtemp
-cachedir = mkdtemp()
+# environment variable holding the cache directory of the current run, set by 
+# preprocessor_cache. worker processes inherit it.
+run_cachedir_env = 'INTERFAIR_RUN_CACHEDIR'
+# number of fitted preprocessors kept in the cache directory of a run
+max_cached_preprocessors = 8
+
+# fitted preprocessors and fitted candidates, by training data fingerprint.
+# these are per process, and are shared by all clones of WarmStartClassifier.
+_preprocessor_cache = {}
+_candidate_archive = {}
+
+@contextmanager
+def preprocessor_cache(root=None):
+    """Shares fitted preprocessors between worker processes during a run.
+
+    Creates a cache directory for the run inside `root`, which defaults to 
+    the INTERFAIR_CACHEDIR environment variable or else the system's 
+    temporary directory. Processes started inside the `with` block, such as 
+    FomoClassifier's workers, use it in fit_preprocessor. The directory and 
+    the in-memory caches are removed on exit. 
+    """
+    if root is None:
+        root = os.environ.get('INTERFAIR_CACHEDIR')
+    path = mkdtemp(prefix='interfair_', dir=root)
+    previous = os.environ.get(run_cachedir_env)
+    os.environ[run_cachedir_env] = path
+    try:
+        yield path
+    finally:
+        if previous is None:
+            del os.environ[run_cachedir_env]
+        else:
+            os.environ[run_cachedir_env] = previous
+        shutil.rmtree(path, ignore_errors=True)
+        _preprocessor_cache.clear()
+        _candidate_archive.clear()
+
+def fit_preprocessor(preprocessor, X, X_fingerprint=None):
+    """Returns preprocessor fit on X and X transformed by it, memoized.
+
+    Results are keyed by a fingerprint of X (computed unless given as 
+    X_fingerprint) and the preprocessor, and are 
+    kept in memory for the most recent training set. Inside 
+    `preprocessor_cache`, they are also kept on disk in the cache directory 
+    of the run, where the least recently used entries beyond 
+    max_cached_preprocessors are evicted. 
+    """
+    if X_fingerprint is None:
+        X_fingerprint = fingerprint(X)
+    key = f'{X_fingerprint}_{joblib.hash(preprocessor)}'
+    if key in _preprocessor_cache:
+        return _preprocessor_cache[key]
+
+    cachedir = os.environ.get(run_cachedir_env)
+    if cachedir is None:
+        fitted = clone(preprocessor).fit(X)
+        Xt = fitted.transform(X)
+    else:
+        fitted, Xt = _load_or_fit_preprocessor(preprocessor, X, cachedir, key)
+
+    _preprocessor_cache.clear()
+    _preprocessor_cache[key] = (fitted, Xt)
+    return fitted, Xt
+
+def _load_or_fit_preprocessor(preprocessor, X, cachedir, key):
+    path = os.path.join(cachedir, f'preprocessor_{key}.joblib')
+    try:
+        fitted, Xt = joblib.load(path)
+        # mark as recently used
+        os.utime(path)
+    except (FileNotFoundError, EOFError):
+        fitted = clone(preprocessor).fit(X)
+        Xt = fitted.transform(X)
+        # write atomically, since other processes may be reading
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        joblib.dump((fitted, Xt), tmp_path)
+        os.replace(tmp_path, path)
+        cached = sorted(
+            glob.glob(os.path.join(cachedir, 'preprocessor_*.joblib')),
+            key=os.path.getmtime
+        )
+        for old_path in cached[:-max_cached_preprocessors]:
+            try:
+                os.remove(old_path)
+            except FileNotFoundError:
+                pass
+    return fitted, Xt
+
+class WarmStartClassifier(ClassifierMixin, BaseEstimator):
+    """Wraps a classifier to reuse work across FomoClassifier candidates.
+
+    Candidates differ only in their sample weights, so:
+
+    - the preprocessor is fit, and the training data transformed, once per 
+      training set (see fit_preprocessor);
+    - with warm_start=True, each fit starts from the archived candidate whose 
+      sample weights are closest, which stands in for the parent of an 
+      offspring. Linear models are initialized with its `coef_` and 
+      `intercept_`. Boosted XGBoost models keep all but the last 
+      `continue_rounds` rounds of its booster and train only that many new 
+      rounds (`xgb_model`), so the model does not grow across generations. 
+      Random forests (XGBRFClassifier) have a single round and are fit from 
+      scratch. 
+
+    Parameters
+    ----------
+    estimator: sklearn-style classifier
+        The base classifier.
+    preprocessor: sklearn-style transformer, optional
+        Applied to X before the estimator. It is fit without sample weights. 
+    warm_start: bool, default: False
+        Warm-start each fit from the closest previously fit candidate.
+    archive_size: int, default: 50
+        Number of fitted candidates kept per training set for warm starts. 
+    continue_rounds: int, default: 10
+        Number of boosting rounds trained when warm-starting an XGBoost model.
+    """
+    def __init__(
+        self, 
+        estimator, 
+        preprocessor=None, 
+        warm_start=False, 
+        archive_size=50,
+        continue_rounds=10
+    ):
+        self.estimator = estimator
+        self.preprocessor = preprocessor
+        self.warm_start = warm_start
+        self.archive_size = archive_size
+        self.continue_rounds = continue_rounds
+
+    # FomoClassifier sets these on its estimator, to seed it and to run it 
+    # single-threaded in each worker. they are not params of this wrapper, so 
+    # clone and get_params are unaffected.
+    @property
+    def random_state(self):
+        return self.estimator.random_state
+
+    @random_state.setter
+    def random_state(self, value):
+        self.estimator.random_state = value
+
+    @property
+    def n_jobs(self):
+        return self.estimator.n_jobs
+
+    @n_jobs.setter
+    def n_jobs(self, value):
+        self.estimator.n_jobs = value
+
+    def _parent(self, archive_key, sample_weight):
+        """Returns the archived candidate closest in sample weights."""
+        archive = _candidate_archive.get(archive_key)
+        if not archive:
+            return None
+        if sample_weight is None:
+            return archive[-1][1]
+        distances = [
+            np.linalg.norm(sample_weight - sw) if sw is not None else np.inf
+            for sw, _ in archive
+        ]
+        return archive[int(np.argmin(distances))][1]
+
+    def fit(self, X, y, sample_weight=None):
+        key = fingerprint(X)
+        if self.preprocessor is None:
+            self.preprocessor_, Xt = None, X
+        else:
+            self.preprocessor_, Xt = fit_preprocessor(
+                self.preprocessor, X, X_fingerprint=key
+            )
+        # scoring predicts on the training data, so reuse its transform
+        self._X_fit = weakref.ref(X)
+        self._Xt_fit = Xt
+        if sample_weight is not None:
+            sample_weight = np.asarray(sample_weight, dtype=float)
+
+        self.estimator_ = clone(self.estimator)
+        fit_kwargs = {}
+        if sample_weight is not None:
+            fit_kwargs['sample_weight'] = sample_weight
+        # candidates are only warm-started from the same kind of estimator
+        archive_key = (key, type(self.estimator).__name__)
+        parent = self._parent(archive_key, sample_weight) if self.warm_start else None
+        if parent is not None:
+            if hasattr(parent, 'get_booster'):
+                booster = parent.get_booster()
+                # replace the parent's last rounds rather than adding to them
+                n_keep = booster.num_boosted_rounds() - self.continue_rounds
+                if n_keep > 0:
+                    self.estimator_.set_params(n_estimators=self.continue_rounds)
+                    fit_kwargs['xgb_model'] = booster[:n_keep]
+            elif hasattr(parent, 'coef_'):
+                self.estimator_.set_params(warm_start=True)
+                self.estimator_.coef_ = parent.coef_.copy()
+                self.estimator_.intercept_ = parent.intercept_.copy()
+        self.estimator_.fit(Xt, y, **fit_kwargs)
+        self.classes_ = self.estimator_.classes_
+
+        if self.warm_start:
+            if archive_key not in _candidate_archive:
+                _candidate_archive.clear()
+                _candidate_archive[archive_key] = deque(maxlen=self.archive_size)
+            _candidate_archive[archive_key].append((sample_weight, self.estimator_))
+        return self
+
+    def _transform(self, X):
+        if self.preprocessor_ is None:
+            return X
+        if getattr(self, '_X_fit', None) is not None and self._X_fit() is X:
+            return self._Xt_fit
+        return self.preprocessor_.transform(X)
+
+    def __getstate__(self):
+        # don't pickle the transformed training data
+        state = super().__getstate__()
+        state.pop('_X_fit', None)
+        state.pop('_Xt_fit', None)
+        return state
+
+    def predict(self, X):
+        return self.estimator_.predict(self._transform(X))
+
+    def predict_proba(self, X):
+        return self.estimator_.predict_proba(self._transform(X))
 
 base_model = LogisticRegression(n_jobs=1, solver='saga',penalty='l1')
 # base_model = RandomForestClassifier(n_jobs=1)
@@ -28,6 +262,20 @@ numeric_features = [
 print('categorical features:',categorical_features)
 print('numeric features:',numeric_features)
 
+def numeric_columns(X):
+    """Returns the numeric_features in X."""
+    return [c for c in numeric_features if c in X.columns]
+
+def categorical_columns(X):
+    """Returns the categorical_features in X, and its other non-numeric columns."""
+    return [
+        c for c in X.columns 
+        if c not in numeric_features and (
+            c in categorical_features 
+            or not pd.api.types.is_numeric_dtype(X[c])
+        )
+    ]
+
 numeric_transformer = make_pipeline(
     SimpleImputer(strategy="median"), 
     StandardScaler()
@@ -35,21 +283,35 @@ numeric_transformer = make_pipeline(
 
 preprocessor = ColumnTransformer(
     [
-        ("num", numeric_transformer, numeric_features),
-        # (
-        #     "cat",
-        #     OneHotEncoder(
-        #         handle_unknown="ignore", 
-        #         sparse_output=False
-        #     ),
-        #     categorical_features,
-        # ),
+        # columns are selected when fit, so that datasets without these 
+        # features are passed through
+        ("num", numeric_transformer, numeric_columns),
+        (
+            "cat",
+            OneHotEncoder(
+                handle_unknown="ignore", 
+                sparse_output=True
+            ),
+            categorical_columns,
+        ),
     ],
     verbose_feature_names_out=False,
-    remainder='passthrough'
+    # other columns are imputed like the numeric features, with an indicator 
+    # of which values were missing. 
+    remainder=SimpleImputer(strategy="median", add_indicator=True),
+    # always output a sparse (CSR) matrix. no NaNs are left, so the zeros 
+    # that are not stored are read as zeros by linear models, and as a 
+    # missing value that is never a NaN by XGBoost.
+    sparse_threshold=1.0
 )
-est = make_pipeline(preprocessor, base_model)
+# the XGBRF model below replaces this one. logistic regression is warm-started, 
+# a random forest cannot be.
+est = WarmStartClassifier(base_model, preprocessor=preprocessor, warm_start=True)
 
 from xgboost import XGBRFClassifier 
 
-est = XGBRFClassifier(n_jobs=1)
\ No newline at end of file
+est = WarmStartClassifier(
+    XGBRFClassifier(n_jobs=1), 
+    preprocessor=preprocessor, 
+    warm_start=False
+)
\ No newline at end of file
@@ -0,0 +1,241 @@
+"""Sufficient statistics for measuring disparity on sharded data.
+
+measure_disparity writes the statistics of one shard with `write_stats`, and
+merge_disparity combines any number of shards with `merge_stats` and reports
+on them as if the shards had been concatenated.
+"""
+import json
+import numpy as np
+import pandas as pd
+
+STATS_VERSION = 1
+
+# per group sums, over the cells formed by all demographic columns
+cell_stats = ['n', 'n_pos', 'sum_w', 'sum_p', 'sum_p_pos', 'sum_sq_err']
+
+def compute_stats(df, demographics, score_decimals=None):
+    """Returns the sufficient statistics of a measure_disparity dataset.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        A dataset as read by `utils.read_measure_dataset`.
+    demographics: list[str]
+        The demographic columns.
+    score_decimals: int | None, default: None
+        If None, `scores` has a row for every distinct model prediction, 
+        i.e. about one per sample for continuous predictions, and AUROC and 
+        AUPRC are exact. Otherwise, predictions are rounded to this many 
+        decimals in `scores`, which then has at most 10**score_decimals + 1 
+        rows, and AUROC and AUPRC are computed from the rounded predictions. 
+        No other statistic is affected.
+
+    Returns
+    -------
+    stats: dict
+        - cells: per-cell sums for every observed combination of demographics
+          (including missing values), with columns demographics + cell_stats.
+        - scores: counts of positive and negative outcomes for each distinct
+          (rounded) model prediction, from which AUROC and AUPRC are computed.
+        - labels: sums of model labels among positive and negative outcomes.
+    """
+    y = df['binary outcome'].to_numpy()
+    # accumulate in float64
+    p = df['model prediction'].to_numpy(dtype=float)
+    w = df['sample weights'].to_numpy(dtype=float)
+    label = df['model label'].to_numpy()
+
+    sums = pd.DataFrame({
+        'n': np.ones(len(df)),
+        'n_pos': y.astype(float),
+        'sum_w': w,
+        'sum_p': p,
+        'sum_p_pos': np.where(y == 1, p, 0.0),
+        'sum_sq_err': (y - p)**2,
+    })
+    for d in demographics:
+        sums[d] = df[d].to_numpy()
+    cells = (
+        sums.groupby(demographics, dropna=False, observed=True)[cell_stats]
+        .sum()
+        .reset_index()
+    )
+
+    p_score = p if score_decimals is None else np.round(p, score_decimals)
+    values, inverse = np.unique(p_score, return_inverse=True)
+    scores = pd.DataFrame({
+        'value': values.astype(float),
+        'pos': np.bincount(inverse, weights=(y == 1), minlength=len(values)),
+        'neg': np.bincount(inverse, weights=(y != 1), minlength=len(values))
+    })
+
+    labels = dict(
+        sum_label_pos=float(label[y == 1].sum()),
+        sum_label_neg=float(label[y != 1].sum())
+    )
+    return dict(
+        version=STATS_VERSION,
+        demographics=list(demographics),
+        cells=cells,
+        scores=scores,
+        labels=labels
+    )
+
+def write_stats(stats, filename):
+    """Writes stats to a json file."""
+    cells = stats['cells'].astype(object)
+    cells = cells.where(cells.notna(), None)
+    out = dict(
+        stats,
+        cells=cells.to_dict(orient='list'),
+        scores=stats['scores'].to_dict(orient='list')
+    )
+    with open(filename, 'w') as f:
+        json.dump(out, f)
+
+def read_stats(filename):
+    """Reads stats written by write_stats."""
+    with open(filename, 'r') as f:
+        stats = json.load(f)
+    assert stats.get('version') == STATS_VERSION, (
+        f'{filename} has stats version {stats.get("version")}, expected '
+        f'{STATS_VERSION}.'
+    )
+    stats['cells'] = pd.DataFrame(stats['cells'])
+    stats['scores'] = pd.DataFrame(stats['scores'])
+    return stats
+
+def merge_stats(stats_list):
+    """Combines the stats of several shards into the stats of their union."""
+    assert len(stats_list) > 0, 'no stats to merge.'
+    demographics = stats_list[0]['demographics']
+    for s in stats_list:
+        assert sorted(s['demographics']) == sorted(demographics), (
+            'shards have different demographic columns: '
+            f'{s["demographics"]} vs {demographics}'
+        )
+    cells = (
+        pd.concat([s['cells'] for s in stats_list])
+        .groupby(demographics, dropna=False)[cell_stats]
+        .sum()
+        .reset_index()
+    )
+    scores = (
+        pd.concat([s['scores'] for s in stats_list])
+        .groupby('value')[['pos','neg']]
+        .sum()
+        .reset_index()
+    )
+    labels = {
+        k: sum(s['labels'][k] for s in stats_list)
+        for k in stats_list[0]['labels']
+    }
+    return dict(
+        version=STATS_VERSION,
+        demographics=demographics,
+        cells=cells,
+        scores=scores,
+        labels=labels
+    )
+
+def summary_from_stats(stats):
+    """Returns the overall performance measures reported by measure_disparity."""
+    # imported here so that shards can be written without sklearn
+    import sklearn.metrics as sklearn_metrics
+
+    total = stats['cells'][cell_stats].sum()
+    n, n_pos = total['n'], total['n_pos']
+    n_neg = n - n_pos
+    labels = stats['labels']
+
+    scores = stats['scores']
+    y_score = np.concatenate([scores['value'], scores['value']])
+    y_true = np.concatenate([np.ones(len(scores)), np.zeros(len(scores))])
+    counts = np.concatenate([scores['pos'], scores['neg']])
+    keep = counts > 0
+    y_score, y_true, counts = y_score[keep], y_true[keep], counts[keep]
+
+    return {
+        'AUROC': sklearn_metrics.roc_auc_score(
+            y_true, y_score, sample_weight=counts
+        ),
+        'AUPRC': sklearn_metrics.average_precision_score(
+            y_true, y_score, sample_weight=counts
+        ),
+        'Positivity Rate': total['sum_p']/n,
+        'FPR': labels['sum_label_neg']/n_neg if n_neg > 0 else 0,
+        'FNR': (n_pos - labels['sum_label_pos'])/n_pos if n_pos > 0 else 0,
+        'Accuracy': (labels['sum_label_pos'] + n_neg - labels['sum_label_neg'])/n
+    }
+
+def _rate(s, metric):
+    """Returns the raw loss and gamma of metric on group stats s."""
+    n, n_pos = s['n'], s['n_pos']
+    n_neg = n - n_pos
+    if metric == 'FNR':
+        raw = (n_pos - s['sum_p_pos'])/n_pos if n_pos > 0 else 0
+        return raw, n_pos/n
+    elif metric == 'FPR':
+        raw = (s['sum_p'] - s['sum_p_pos'])/n_neg if n_neg > 0 else 0
+        return raw, n_neg/n
+    elif metric == 'MSE':
+        return s['sum_sq_err']/n, None
+    elif metric == 'positivity':
+        return s['sum_p']/n, None
+    raise ValueError(f'metric={metric} must be "FPR", "FNR", "MSE" or "positivity"')
+
+def subgroup_loss_from_stats(stats, metric, grouping='intersectional'):
+    """Returns the per-group losses of metrics.subgroup_loss, from stats.
+
+    Deviations are weighted by gamma and by the mean sample weight, as
+    measure_disparity does.
+
+    Returns
+    -------
+    df_losses: pd.DataFrame
+        Indexed by demographics, with columns value, signed_value, raw_value
+        and raw_value_pct.
+    """
+    cells = stats['cells']
+    groups = stats['demographics']
+    total = cells[cell_stats].sum()
+    base_loss, _ = _rate(total, metric)
+
+    if grouping == 'intersectional':
+        # as metrics.group_layout does, missing values form groups only in 
+        # combinations
+        if len(groups) == 1:
+            cells = cells.dropna(subset=groups)
+        group_sums = cells.groupby(groups, dropna=False)[cell_stats].sum()
+        keys = [
+            {g:v for g,v in zip(groups, k if isinstance(k, tuple) else (k,))}
+            for k in group_sums.index
+        ]
+    elif grouping == 'marginal':
+        group_sums, keys = [], []
+        for g in groups:
+            sums = cells.dropna(subset=[g]).groupby(g)[cell_stats].sum()
+            group_sums.append(sums)
+            for k in sums.index:
+                measure = {g:k}
+                for other in [o for o in groups if o != g]:
+                    measure[other] = '  any  '
+                keys.append(measure)
+        group_sums = pd.concat(group_sums)
+    else:
+        raise ValueError(f'grouping={grouping} must be "intersectional" or "marginal"')
+
+    category_losses = []
+    for measure, (_, s) in zip(keys, group_sums.iterrows()):
+        raw_loss, gamma = _rate(s, metric)
+        if gamma is None:
+            gamma = s['n']/total['n']
+        signed_deviation = (raw_loss - base_loss)*gamma*s['sum_w']/s['n']
+        measure = dict(measure)
+        measure['value'] = np.abs(signed_deviation)
+        measure['signed_value'] = signed_deviation
+        measure['raw_value'] = raw_loss-base_loss
+        measure['raw_value_pct'] = np.abs(raw_loss-base_loss)/base_loss*100
+        category_losses.append(measure)
+
+    return pd.DataFrame(category_losses).set_index(groups)
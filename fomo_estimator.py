@@ -2,15 +2,157 @@ from base_model import est as base_estimator
 from fomo import FomoClassifier
 from fomo.problem import MLPProblem
 import fomo.metrics as metrics
+from metrics import SubgroupScorer
 from pymoo.algorithms.moo.nsga2 import NSGA2
 from sklearn.metrics import make_scorer
 from pymoo.operators.crossover.sbx import SBX
-from pymoo.termination.default import DefaultMultiObjectiveTermination
+from pymoo.core.callback import Callback
+from pymoo.core.termination import Termination
+from pymoo.termination.max_eval import MaximumFunctionCallTermination
+from pymoo.termination.max_gen import MaximumGenerationTermination
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+def hypervolume_2d(F, ref_point):
+    """Returns the hypervolume of 2-D points F (minimized) w.r.t. ref_point.
+
+    Sorts the points once and sweeps them, so it is O(n log n).
+    """
+    F = F[np.all(F < ref_point, axis=1)]
+    F = F[np.lexsort((F[:,1], F[:,0]))]
+    hv = 0.0
+    f2_prev = ref_point[1]
+    for f1, f2 in F:
+        if f2 < f2_prev:
+            hv += (ref_point[0] - f1)*(f2_prev - f2)
+            f2_prev = f2
+    return hv
+
+class HypervolumeTermination(Termination):
+    """Stops when the hypervolume of the Pareto front stops improving.
+
+    The hypervolume of the current front (algorithm.opt) is computed every 
+    generation and stored in `history`. The run terminates when the 
+    relative improvement over the last `window` generations is below `tol`, 
+    or when n_max_gen or n_max_evals is reached. 
+
+    `minimize` runs on a copy of the termination, so read the history from 
+    `algorithm.termination`. FomoClassifier with checkpoint=True sets up its 
+    algorithm with this object itself, so call `reset` before reusing it for 
+    another run.
+
+    Parameters
+    ----------
+    ref_point: tuple, default: (1.0, 1.0)
+        Reference point for the hypervolume. Both objectives are rates, so 
+        the default bounds them.
+    tol: float, default: 0.001
+        Minimum relative improvement in hypervolume over `window` generations.
+    window: int, default: 10
+        Number of generations over which improvement is measured.
+    n_max_gen: int, default: 100
+        Maximum number of generations.
+    n_max_evals: int, default: 100000
+        Maximum number of function evaluations.
+    verbose: bool, default: False
+        Print the hypervolume each generation. It is always logged.
+    """
+    def __init__(
+        self, 
+        ref_point=(1.0, 1.0), 
+        tol=0.001, 
+        window=10, 
+        n_max_gen=100, 
+        n_max_evals=100000, 
+        verbose=False
+    ):
+        super().__init__()
+        self.ref_point = np.asarray(ref_point, dtype=float)
+        self.tol = tol
+        self.window = window
+        self.max_gen = MaximumGenerationTermination(n_max_gen)
+        self.max_evals = MaximumFunctionCallTermination(n_max_evals)
+        self.verbose = verbose
+        self.history = []
+
+    def reset(self):
+        """Clears the history and progress of a previous run."""
+        self.history = []
+        self.perc = 0.0
+        self.force_termination = False
+        self.max_gen.perc = self.max_evals.perc = 0.0
+
+    def _update(self, algorithm):
+        hv = hypervolume_2d(algorithm.opt.get('F'), self.ref_point)
+        self.history.append((algorithm.n_gen, hv))
+        logger.info(f'gen {algorithm.n_gen}: hypervolume = {hv:.6f}')
+        if self.verbose:
+            print(f'gen {algorithm.n_gen}: hypervolume = {hv:.6f}')
+
+        progress = max(
+            self.max_gen.update(algorithm), 
+            self.max_evals.update(algorithm)
+        )
+        if len(self.history) > self.window:
+            hv_prev = self.history[-1-self.window][1]
+            improvement = (hv - hv_prev)/hv_prev if hv_prev > 0 else np.inf
+            if improvement < self.tol:
+                return 1.0
+        return progress
+
+class HistoryCallback(Callback):
+    """Records compact per-generation history to a file.
+
+    A lean alternative to `save_history=True`, which keeps a copy of the 
+    whole algorithm, fitted models included, for every generation. Each 
+    generation, the decision vectors (X) and objective values (F) of the 
+    population are appended to `history_file` as float32 arrays, and nothing 
+    is kept in memory. The file is a sequence of .npy records, so `np.load` 
+    reads only the first one; read it with `load_history`.
+
+    Parameters
+    ----------
+    history_file: str, default: 'history.bin'
+        File that records are written to. 
+    append: bool, default: False
+        Append to an existing history_file, e.g. when resuming from a 
+        checkpoint. Otherwise it is overwritten by the first generation.
+    """
+    def __init__(self, history_file='history.bin', append=False):
+        super().__init__()
+        self.history_file = history_file
+        self.append = append
+        self._truncate = not append
+
+    def notify(self, algorithm):
+        pop = algorithm.pop
+        with open(self.history_file, 'wb' if self._truncate else 'ab') as f:
+            np.save(f, np.array([algorithm.n_gen, algorithm.evaluator.n_eval]))
+            np.save(f, pop.get('X').astype(np.float32))
+            np.save(f, pop.get('F').astype(np.float32))
+        self._truncate = False
+
+def load_history(history_file):
+    """Reads the records written by HistoryCallback.
+
+    Returns
+    -------
+    history: list[dict]
+        One dict per generation with keys n_gen, n_evals, X and F.
+    """
+    history = []
+    with open(history_file, 'rb') as f:
+        while f.peek(1):
+            (n_gen, n_evals), X, F = np.load(f), np.load(f), np.load(f)
+            history.append(dict(n_gen=n_gen, n_evals=n_evals, X=X, F=F))
+    return history
 
 est = FomoClassifier(
     estimator = base_estimator,
     accuracy_metrics=[make_scorer(metrics.FPR)],
-    fairness_metrics=[metrics.subgroup_FNR_scorer],
+    fairness_metrics=[SubgroupScorer('FNR')],
     algorithm = NSGA2(pop_size=50),
     verbose=True,
     problem_type=MLPProblem,
@@ -18,11 +160,11 @@ est = FomoClassifier(
 )
 est.n_jobs=min(64, est.algorithm.pop_size)
 # est.n_jobs=1
-termination = DefaultMultiObjectiveTermination(
-    xtol=1e-8,
-    cvtol=1e-6,
-    ftol=0.0025,
-    period=30,
+termination = HypervolumeTermination(
+    ref_point=(1.0, 1.0),
+    tol=0.001,
+    window=10,
     n_max_gen=100,
-    n_max_evals=100000
+    n_max_evals=100000,
+    verbose=True
 )
\ No newline at end of file
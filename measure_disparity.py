@@ -3,13 +3,27 @@ import pandas as pd
 import fire
 import sklearn.metrics as sklearn_metrics
 import metrics 
-from utils import nice_metrics
+from utils import nice_metrics, read_measure_dataset
+from disparity_stats import compute_stats, write_stats
 import warnings
 warnings.simplefilter('ignore')
 
+md_args = dict(
+    index=False, 
+    # tablefmt = 'fancy_outline'
+    tablefmt = 'rounded_outline',
+    stralign="right"
+)
+
 def measure_disparity(
     dataset: str,
-    save_file: str = 'df_fairness.csv'
+    save_file: str = 'df_fairness.csv',
+    sweep: bool = False,
+    thresholds: int = 101,
+    max_error_rate: float = 0.5,
+    sweep_file: str = 'df_thresholds.csv',
+    shard_file: str|None = None,
+    score_decimals: int|None = None
 ):
     """Return prediction measures of disparity with respect to groups in dataset.
 
@@ -28,6 +42,33 @@ def measure_disparity(
     save_file: str, default: df_fairness.csv
         The name of the save file. 
 
+    sweep: bool, default: False
+        Also measure FPR, FNR and positivity disparities across decision 
+        thresholds on `model prediction`, rather than only at `model label`.
+
+    thresholds: int, default: 101
+        Number of evenly spaced thresholds in [0, 1] to sweep. 
+
+    max_error_rate: float, default: 0.5
+        Thresholds at which the population FPR or FNR exceeds this are not 
+        considered when choosing the thresholds with the least deviation. 
+        Near 0 or 1, a threshold labels almost everyone the same, so the 
+        deviations vanish but the model is of no use.
+
+    sweep_file: str, default: df_thresholds.csv
+        The name of the threshold sweep save file. 
+
+    shard_file: str | None, default: None
+        If set, dataset is treated as one shard of a larger dataset: its 
+        per-group statistics are written to this file and no report is made. 
+        Combine shard files with `merge_disparity`.
+
+    score_decimals: int | None, default: None
+        With shard_file, optionally round model predictions to this many 
+        decimals for AUROC and AUPRC. By default they are exact, and the 
+        shard file grows with the number of distinct predictions; rounding 
+        bounds its size, at the cost of approximate AUROC and AUPRC. 
+
     Outputs
     -------
 
@@ -39,9 +80,14 @@ def measure_disparity(
         Identifies groups experiencing the largest percent differences in performance according to each metric.  
     save_file: str, default df_fairness.csv
         Writes a csv file containing the fairness results.
+    Threshold Sweep
+        If `sweep` is set, the thresholds that minimize the largest subgroup 
+        deviation in each metric, among those within `max_error_rate`. 
+    sweep_file: str, default df_thresholds.csv
+        If `sweep` is set, writes a csv file containing the threshold curves.
     """
     print('reading in',dataset)
-    df = pd.read_csv(dataset)
+    df = read_measure_dataset(dataset)
     required_cols = [
         'model prediction','binary outcome','model label','sample weights'
     ]
@@ -52,6 +98,14 @@ def measure_disparity(
     print('demographic columns:',demographics)
     assert len(demographics) > 0, 'no demographic columns found.'
 
+    if shard_file is not None:
+        print('saving shard statistics to',shard_file)
+        write_stats(
+            compute_stats(df, demographics, score_decimals=score_decimals), 
+            shard_file
+        )
+        return
+
     weights = df['sample weights']
 
     soft_predictive_measures = [
@@ -71,21 +125,10 @@ def measure_disparity(
         metrics.subgroup_positivity_loss, 
         # metrics.multicalibration_loss, 
     ]
-    y = df['binary outcome'].astype(int)
+    y = df['binary outcome']
     y_pred = df['model label']
     y_pred_proba = df['model prediction']
 
-    md_args = dict(
-        index=False, 
-        # tablefmt = 'fancy_outline'
-        tablefmt = 'rounded_outline',
-        stralign="right"
-    )
-
-    print(40*'=')
-    print('Overall Performance')
-    print(40*'=')
-    print('\tMeasures of predictive bias on the whole population.')
     summary = {}
     for pm in soft_predictive_measures:
         name = nice_metrics.get(pm.__name__,pm.__name__)
@@ -93,15 +136,7 @@ def measure_disparity(
     for pm in hard_predictive_measures:
         name = nice_metrics.get(pm.__name__,pm.__name__)
         summary[name] = pm(y, y_pred)
-    df_summary = pd.DataFrame(summary, index=['value'])
-    print(df_summary.round(3).to_markdown(**md_args))
-
 
-    print(40*'=')
-    print('Subgroup Fairness Violations')
-    print(40*'=')
-    print('\tMeasures the deviation in performance for marginal and intersectional groups.')
-    print('\tNote that these deviation are weighted by group prevalence to produce stable estimates when sample sizes are small.')
     X_protected = df[demographics]
     frames = []
     for sm in social_measures:
@@ -116,6 +151,72 @@ def measure_disparity(
             result['grouping'] = grouping
             frames.append(result)
 
+    report_disparity(summary, frames, save_file)
+
+    if sweep:
+        print(40*'=')
+        print('Threshold Sweep')
+        print(40*'=')
+        print('\tThresholds that minimize the largest deviation in performance among marginal and intersectional groups,')
+        print(f'\tamong thresholds with population FPR and FNR of at most {max_error_rate}.')
+        df_sweep = metrics.threshold_sweep(
+            y, y_pred_proba, X_protected, 
+            thresholds=thresholds,
+            weights=weights
+        )
+        print('saving threshold sweep to',sweep_file)
+        df_sweep.to_csv(sweep_file, index=False)
+        df_valid = df_sweep.loc[
+            (df_sweep['FPR'] <= max_error_rate) & (df_sweep['FNR'] <= max_error_rate)
+        ]
+        if len(df_valid) == 0:
+            print(f'No threshold has FPR and FNR of at most {max_error_rate}.')
+            return
+        best = []
+        for col in ['FPR','FNR','Positivity Rate','max']:
+            row = df_valid.loc[df_valid[f'{col} deviation'].idxmin()]
+            best.append({
+                'deviation': col,
+                'threshold': row['threshold'],
+                'value': row[f'{col} deviation'],
+                'FPR': row['FPR'],
+                'FNR': row['FNR'],
+                'Positivity Rate': row['Positivity Rate']
+            })
+        print(pd.DataFrame(best).round(3).to_markdown(**md_args))
+
+def report_disparity(summary, frames, save_file):
+    """Prints the disparity report and saves the fairness results.
+
+    Parameters
+    ----------
+    summary: dict
+        Overall performance measures, by name.
+    frames: list[pd.DataFrame]
+        Subgroup losses, as returned by `metrics.subgroup_loss`, with 
+        additional `metric` and `grouping` columns. 
+    save_file: str
+        The name of the save file. 
+
+    Returns
+    -------
+    df_fairness: pd.DataFrame
+        Signed deviations of each group, by metric.
+    """
+    print(40*'=')
+    print('Overall Performance')
+    print(40*'=')
+    print('\tMeasures of predictive bias on the whole population.')
+    df_summary = pd.DataFrame(summary, index=['value'])
+    print(df_summary.round(3).to_markdown(**md_args))
+
+
+    print(40*'=')
+    print('Subgroup Fairness Violations')
+    print(40*'=')
+    print('\tMeasures the deviation in performance for marginal and intersectional groups.')
+    print('\tNote that these deviation are weighted by group prevalence to produce stable estimates when sample sizes are small.')
+
     df_fairness = (
         pd.concat(frames)
         .pivot(columns=['metric'], values=['signed_value'])
@@ -157,6 +258,7 @@ def measure_disparity(
 
     print('saving results to',save_file)
     df_fairness.reset_index().to_csv(save_file, index=False)
+    return df_fairness
 
 if __name__ == '__main__':
     fire.Fire(measure_disparity)
\ No newline at end of file
@@ -0,0 +1,53 @@
+import fire
+from disparity_stats import read_stats, merge_stats, summary_from_stats, subgroup_loss_from_stats
+from measure_disparity import report_disparity
+
+def merge_disparity(
+    *shard_files: str,
+    save_file: str = 'df_fairness.csv'
+):
+    """Return prediction measures of disparity from the shards of a dataset.
+
+    Produces the report of `measure_disparity` on the concatenation of the 
+    shards, from the per-group statistics of each shard. If the shards were 
+    written with `score_decimals`, AUROC and AUPRC are computed from the 
+    rounded predictions. 
+
+    Parameters
+    ----------
+
+    shard_files: str
+        Files written by `measure_disparity` with the `shard_file` argument, 
+        one per shard.
+
+    save_file: str, default: df_fairness.csv
+        The name of the save file. 
+
+    Outputs
+    -------
+
+    The same outputs as `measure_disparity`, except for the threshold sweep, 
+    which needs the model predictions of every individual. 
+    """
+    print('merging',len(shard_files),'shards')
+    stats = merge_stats([read_stats(f) for f in shard_files])
+    print('demographic columns:',stats['demographics'])
+
+    social_measures = {
+        'FNR':'FNR',
+        'FPR':'FPR',
+        'Brier Score (MSE)':'MSE',
+        'Positivity Rate':'positivity'
+    }
+    frames = []
+    for name, metric in social_measures.items():
+        for grouping in ['marginal','intersectional']:
+            result = subgroup_loss_from_stats(stats, metric, grouping)
+            result['metric'] = name
+            result['grouping'] = grouping
+            frames.append(result)
+
+    report_disparity(summary_from_stats(stats), frames, save_file)
+
+if __name__ == '__main__':
+    fire.Fire(merge_disparity)
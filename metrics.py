@@ -10,7 +10,7 @@ import logging
 import itertools as it
 from fomo.utils import categorize 
 from sklearn.metrics import mean_squared_error
-from utils import get_groups
+from utils import get_groups, fingerprint
 
 logger = logging.getLogger(__name__)
 
@@ -37,19 +37,22 @@ def stratify_groups(X, y, groups,
         n_bins=len(bins)
 
 
-    df = X[groups].copy()
-    df.loc[:,'interval'], retbins = pd.cut(y, bins, 
-                                           include_lowest=True,
-                                           retbins=True
-                                          )
+    # group X's columns in place rather than copying X[groups]
+    intervals = pd.Series(
+        pd.cut(y, bins, include_lowest=True), 
+        index=X.index
+    )
     stratified_categories = {}
     min_size = gamma*alpha*len(X)/n_bins
-    for group, dfg in df.groupby(groups):
+    for group, i in X.groupby(groups, observed=True).indices.items():
+        # keys are tuples, as when iterating over the groupby
+        group = group if isinstance(group, tuple) else (group,)
         # filter groups smaller than gamma*len(X)
-        if len(dfg)/len(X) <= gamma:
+        if len(i)/len(X) <= gamma:
             continue
         
-        for interval, j in dfg.groupby('interval').groups.items():
+        dfg = intervals.iloc[i]
+        for interval, j in dfg.groupby(dfg, observed=True).groups.items():
             if len(j) > min_size:
                 if interval not in stratified_categories.keys():
                     stratified_categories[interval] = {}
@@ -181,7 +184,7 @@ def positivity(y_true, y_pred):
     If y_pred is floats, this is the "soft" false positive rate 
     (i.e. the average probability estimate for the negative class)
     """
-    return np.sum(y_pred)/len(y_pred)
+    return np.asarray(y_pred).sum(dtype=float)/len(y_pred)
 
 def TPR(y_true, y_pred):
     """Returns True Positive Rate.
@@ -211,11 +214,7 @@ def FPR(y_true, y_pred):
     If y_pred is floats, this is the "soft" false positive rate 
     (i.e. the average probability estimate for the negative class)
     """
-    # if there are no negative labels, return zero
-    if np.sum(y_true) == len(y_true):
-        return 0
-    yt = y_true.astype(bool)
-    return np.sum(y_pred[~yt])/np.sum(~yt)
+    return fused_rates(np.asarray(y_true), np.asarray(y_pred))[RATE_FPR]
 
 def FNR(y_true, y_pred):
     """Returns False Negative Rate.
@@ -230,11 +229,135 @@ def FNR(y_true, y_pred):
     If y_pred is floats, this is the "soft" false negative rate 
     (i.e. the average probability estimate for the negative class)
     """
-    # if there are no postive labels, return zero
-    if np.sum(y_true) == 0:
-        return 0
-    yt = y_true.astype(bool)
-    return np.sum(1-y_pred[yt])/np.sum(yt)
+    return fused_rates(np.asarray(y_true), np.asarray(y_pred))[RATE_FNR]
+
+# column layout of the buffers filled by fused_rates and group_rates
+RATE_FPR, RATE_FNR, RATE_NEG, RATE_POS, RATE_WEIGHT = range(5)
+N_RATES = 5
+
+def fused_rates(y_true, y_pred, weights=None, out=None):
+    """Computes soft FPR, FNR, outcome prevalences and mean weight in one pass.
+
+    The rates are computed from sums and a dot product, so no boolean masks 
+    or negated copies are allocated. 
+
+    Parameters
+    ----------
+    y_true: ndarray of bool, int or float
+        True labels (0 or 1). 
+    y_pred: ndarray of bool, int or float
+        Predicted probabilities or labels. 
+    weights: ndarray, optional
+        Sample weights. Only their mean is computed.
+    out: ndarray of shape (N_RATES,), optional
+        Preallocated output buffer. 
+
+    Returns
+    -------
+    out: ndarray of shape (N_RATES,)
+        Indexed by RATE_FPR, RATE_FNR, RATE_NEG (fraction of negative labels, 
+        i.e. gamma for FPR), RATE_POS (fraction of positive labels, i.e. gamma 
+        for FNR) and RATE_WEIGHT (mean weight, 1 if weights is None).
+    """
+    if out is None:
+        out = np.empty(N_RATES)
+    n = len(y_true)
+    # accumulate in float64 without casting copies of compact inputs
+    n_pos = y_true.sum(dtype=float)
+    n_neg = n - n_pos
+    true_pos = np.einsum('i,i->', y_pred, y_true, dtype=float, casting='safe')
+    # if there are no negative (positive) labels, FPR (FNR) is zero
+    out[RATE_FPR] = (y_pred.sum(dtype=float) - true_pos)/n_neg if n_neg > 0 else 0.0
+    out[RATE_FNR] = (n_pos - true_pos)/n_pos if n_pos > 0 else 0.0
+    out[RATE_NEG] = n_neg/n
+    out[RATE_POS] = n_pos/n
+    out[RATE_WEIGHT] = 1.0 if weights is None else weights.mean(dtype=float)
+    return out
+
+def group_rates(y_true, y_pred, bounds, weights=None, out=None):
+    """Applies fused_rates to each group of data sorted by group.
+
+    The sums of all groups are taken at once with np.add.reduceat over 
+    bounds, so the cost does not grow with the number of groups beyond 
+    vector operations of that length. 
+
+    Parameters
+    ----------
+    y_true, y_pred, weights: ndarray
+        Arrays ordered so that group i occupies [bounds[i], bounds[i+1]). 
+        See group_layout.
+    bounds: ndarray of int
+        Group boundaries, of length n_groups + 1. Groups must not be empty.
+    out: ndarray of shape (n_groups, N_RATES), optional
+        Preallocated output buffer. 
+
+    Returns
+    -------
+    out: ndarray of shape (n_groups, N_RATES)
+    """
+    n_groups = len(bounds) - 1
+    if out is None:
+        out = np.empty((n_groups, N_RATES))
+    if n_groups == 0:
+        return out
+    starts = bounds[:-1]
+    n = np.diff(bounds).astype(float)
+    # accumulate in float64, as fused_rates does
+    n_pos = np.add.reduceat(y_true, starts, dtype=float)
+    n_neg = n - n_pos
+    true_pos = np.add.reduceat(
+        np.multiply(y_pred, y_true, dtype=float), starts
+    )
+    sum_pred = np.add.reduceat(y_pred, starts, dtype=float)
+    # if there are no negative (positive) labels, FPR (FNR) is zero
+    out[:,RATE_FPR] = 0.0
+    np.divide(sum_pred - true_pos, n_neg, out=out[:,RATE_FPR], where=n_neg > 0)
+    out[:,RATE_FNR] = 0.0
+    np.divide(n_pos - true_pos, n_pos, out=out[:,RATE_FNR], where=n_pos > 0)
+    np.divide(n_neg, n, out=out[:,RATE_NEG])
+    np.divide(n_pos, n, out=out[:,RATE_POS])
+    if weights is None:
+        out[:,RATE_WEIGHT] = 1.0
+    else:
+        np.divide(
+            np.add.reduceat(weights, starts, dtype=float), n, 
+            out=out[:,RATE_WEIGHT]
+        )
+    return out
+
+def group_layout(X_protected, groups, grouping):
+    """Returns the groups of X_protected as contiguous slices of a permutation.
+
+    Returns
+    -------
+    keys: list
+        Group keys, in the order of get_groups. 
+    order: ndarray of int
+        Positions of the samples, sorted by group. Marginal groups overlap, so 
+        samples may appear more than once. 
+    bounds: ndarray of int
+        Group i is order[bounds[i]:bounds[i+1]].
+    """
+    if grouping=='intersectional':
+        # as in get_groups, missing values form groups only in combinations 
+        # of several columns
+        indices = X_protected.groupby(
+            groups, observed=True, dropna=len(groups) == 1
+        ).indices
+        keys = list(indices.keys())
+        positions = list(indices.values())
+    elif grouping=='marginal':
+        keys, positions = [], []
+        for g in groups:
+            for k,v in X_protected.groupby(g, observed=True).indices.items():
+                keys.append((g,k))
+                positions.append(v)
+    else:
+        raise ValueError(f'grouping={grouping} must be "intersectional" or "marginal"')
+    order = np.concatenate(positions) if positions else np.empty(0, dtype=int)
+    bounds = np.zeros(len(positions)+1, dtype=int)
+    np.cumsum([len(p) for p in positions], out=bounds[1:])
+    return keys, order, bounds
 
 
 def subgroup_loss(
@@ -247,16 +370,7 @@ def subgroup_loss(
     grouping='intersectional'
     ):
     assert isinstance(X_protected, pd.DataFrame), "X should be a dataframe"
-    if not isinstance(y_true, pd.Series):
-        y_true = pd.Series(y_true, index=X_protected.index)
-    else:
-        y_true.index = X_protected.index
-
-    y_pred = pd.Series(y_pred, index=X_protected.index)
-
     groups = list(X_protected.columns)
-    # categories = X_protected.groupby(groups).groups
-    categories = get_groups(X_protected, groups, grouping)
 
     if isinstance(metric,str):
         loss_fn = FPR if metric=='FPR' else FNR
@@ -265,31 +379,58 @@ def subgroup_loss(
     else:
         raise ValueError(f'metric={metric} must be "FPR", "FNR", or a callable')
 
-    base_loss = loss_fn(y_true, y_pred)
-    max_loss = 0.0
-    signed_max_loss = 0.0
-    max_group = None
     use_weights = weights is not None
-    category_losses = []
-    for c, idx in categories.items():
-        raw_loss = loss_fn(
-            y_true.loc[idx].values, 
-            y_pred.loc[idx].values
+    if loss_fn in (FPR, FNR):
+        # fused path: all group rates from one permutation of the data
+        keys, order, bounds = group_layout(X_protected, groups, grouping)
+        yt = np.asarray(y_true)
+        yp = np.asarray(y_pred)
+        rates = group_rates(
+            yt[order], 
+            yp[order], 
+            bounds, 
+            np.asarray(weights)[order] if use_weights else None
         )
-        signed_deviation = raw_loss - base_loss
+        col, gamma_col = (
+            (RATE_FPR, RATE_NEG) if loss_fn == FPR else (RATE_FNR, RATE_POS)
+        )
+        base_loss = fused_rates(yt, yp)[col]
+        raw_losses = rates[:,col]
+        signed_deviations = raw_losses - base_loss
+        # for FPR and FNR, gamma is also conditioned on the outcome probability
         if use_gamma:
-            # for FPR and FNR, gamma is also conditioned on the outcome probability
-            if metric=='FPR' or loss_fn == FPR: 
-                gamma = 1 - np.sum(y_true.loc[idx])/len(y_true.loc[idx])
-            elif metric=='FNR' or loss_fn == FNR: 
-                gamma = np.sum(y_true.loc[idx])/len(y_true.loc[idx])
-            else:
-                gamma = len(idx) / len(X_protected)
-            signed_deviation *= gamma
+            signed_deviations *= rates[:,gamma_col]
         if use_weights:
-            weight = weights.loc[idx].mean()
-            signed_deviation *= weight
+            signed_deviations *= rates[:,RATE_WEIGHT]
+    else:
+        y_true = pd.Series(
+            np.asarray(y_true), index=X_protected.index, copy=False
+        )
+        y_pred = pd.Series(
+            np.asarray(y_pred), index=X_protected.index, copy=False
+        )
+        categories = get_groups(X_protected, groups, grouping)
+        keys = list(categories.keys())
+        base_loss = loss_fn(y_true, y_pred)
+        raw_losses = np.empty(len(keys))
+        signed_deviations = np.empty(len(keys))
+        for i, idx in enumerate(categories.values()):
+            raw_losses[i] = loss_fn(
+                y_true.loc[idx].values, 
+                y_pred.loc[idx].values
+            )
+            signed_deviations[i] = raw_losses[i] - base_loss
+            if use_gamma:
+                signed_deviations[i] *= len(idx) / len(X_protected)
+            if use_weights:
+                signed_deviations[i] *= weights.loc[idx].mean()
 
+    max_loss = 0.0
+    max_group = None
+    category_losses = []
+    for c, raw_loss, signed_deviation in zip(
+        keys, raw_losses, signed_deviations
+    ):
         abs_deviation = np.abs(signed_deviation)
 
         if grouping=='intersectional':
@@ -325,6 +466,113 @@ def subgroup_MSE_loss(y_true, y_pred, X_protected, **kwargs):
 def subgroup_positivity_loss(y_true, y_pred, X_protected, **kwargs):
     return subgroup_loss(y_true, y_pred, X_protected, positivity, **kwargs)
 
+def hard_rates(y_true, y_pred, thresholds):
+    """Returns FPR, FNR and positivity of y_pred >= t for each t in thresholds.
+
+    y_pred is sorted once, and the rates at every threshold are read off the 
+    cumulative count of positive labels.
+
+    Returns
+    -------
+    rates: ndarray of shape (3, len(thresholds))
+        FPR, FNR and positivity rate.
+    """
+    order = np.argsort(y_pred, kind='stable')
+    y_sorted = y_pred[order]
+    cum_pos = np.zeros(len(y_pred)+1)
+    np.cumsum(y_true[order], out=cum_pos[1:])
+    n = len(y_pred)
+    n_pos = cum_pos[-1]
+    n_neg = n - n_pos
+    # number of samples labeled negative at each threshold
+    if y_sorted.dtype.kind == 'f':
+        # avoid casting a copy of y_sorted to the dtype of thresholds
+        thresholds = thresholds.astype(y_sorted.dtype)
+    n_below = np.searchsorted(y_sorted, thresholds, side='left')
+    false_neg = cum_pos[n_below]
+    false_pos = (n - n_below) - (n_pos - false_neg)
+    rates = np.zeros((3, len(thresholds)))
+    if n_neg > 0:
+        rates[0] = false_pos/n_neg
+    if n_pos > 0:
+        rates[1] = false_neg/n_pos
+    rates[2] = (n - n_below)/n
+    return rates
+
+def threshold_sweep(
+    y_true, 
+    y_pred, 
+    X_protected, 
+    thresholds=101, 
+    weights=None,
+    groupings=('marginal','intersectional')
+):
+    """Computes FPR, FNR and positivity disparities across decision thresholds.
+
+    Predictions are sorted once per group, so the whole curve costs about as 
+    much as a single evaluation. Deviations are weighted as in subgroup_loss: 
+    by gamma (the group's outcome prevalence for FPR and FNR, its size for 
+    positivity) and by the group's mean sample weight. 
+
+    Parameters
+    ----------
+    y_true: array-like, bool
+        True labels.
+    y_pred: array-like, float
+        Predicted probabilities. Samples are labeled positive if 
+        y_pred >= threshold.
+    X_protected: pd.DataFrame
+        Demographic columns that define the groups.
+    thresholds: int | array-like | None, default: 101
+        Thresholds to evaluate. If an int, that many evenly spaced thresholds 
+        in [0, 1]. If None, every distinct prediction is used, which gives 
+        the exact curve but as many rows as there are distinct predictions.
+    weights: array-like, optional
+        Sample weights.
+    groupings: tuple
+        Groupings whose groups are included.
+
+    Returns
+    -------
+    df_sweep: pd.DataFrame
+        One row per threshold, with the population FPR, FNR and positivity 
+        rate and the largest absolute group deviation in each. 
+    """
+    yt = np.asarray(y_true)
+    yp = np.asarray(y_pred)
+    if thresholds is None:
+        thresholds = np.unique(yp)
+    elif np.isscalar(thresholds):
+        thresholds = np.linspace(0.0, 1.0, int(thresholds))
+    thresholds = np.asarray(thresholds, dtype=float)
+
+    base = hard_rates(yt, yp, thresholds)
+    worst = np.zeros_like(base)
+    groups = list(X_protected.columns)
+    for grouping in groupings:
+        _, order, bounds = group_layout(X_protected, groups, grouping)
+        yt_g = yt[order]
+        yp_g = yp[order]
+        w_g = None if weights is None else np.asarray(weights)[order]
+        for s, e in zip(bounds[:-1], bounds[1:]):
+            n_pos = yt_g[s:e].sum()
+            n = e - s
+            gamma = np.array([(n-n_pos)/n, n_pos/n, n/len(yt)])
+            deviation = (hard_rates(yt_g[s:e], yp_g[s:e], thresholds) - base)
+            deviation *= gamma[:,None]
+            if w_g is not None:
+                deviation *= w_g[s:e].mean()
+            np.maximum(worst, np.abs(deviation), out=worst)
+
+    names = ['FPR','FNR','Positivity Rate']
+    df_sweep = pd.DataFrame({'threshold':thresholds})
+    for name, rate in zip(names, base):
+        df_sweep[name] = rate
+    for name, dev in zip(names, worst):
+        df_sweep[f'{name} deviation'] = dev
+    df_sweep['max deviation'] = worst.max(axis=0)
+    return df_sweep
+
 def subgroup_scorer(
     estimator,
     X,
@@ -361,3 +609,166 @@ def subgroup_FNR_scorer(estimator, X, y_true, **kwargs):
 def subgroup_MSE_scorer(estimator, X, y_true, **kwargs):
     return subgroup_scorer( estimator, X, y_true, mean_squared_error, **kwargs)
 
+
+# group layouts by data fingerprint. FomoClassifier pickles the scorer and 
+# its data for every candidate evaluated in a worker process, so identity 
+# checks alone would miss; this cache is per process and keeps the last layout.
+_layout_cache = {}
+
+class SubgroupScorer:
+    """Subgroup FPR/FNR scorer that caches the group layout of its data.
+
+    Returns the same max loss as fomo.metrics.subgroup_FPR_scorer / 
+    subgroup_FNR_scorer, which FomoClassifier optimizes. The groups are 
+    computed once per training set and the loss is computed into 
+    preallocated buffers, so that repeated calls during optimization cost 
+    little more than estimator.predict_proba. 
+
+    Parameters
+    ----------
+    metric: str, default: 'FNR'
+        'FPR' or 'FNR'.
+    grouping: str, default: 'intersectional'
+        'intersectional' or 'marginal'.
+    use_gamma: bool, default: True
+        Weight deviations by gamma.
+    abs_val: bool, default: True
+        Score absolute deviations. Otherwise, only groups that fare worse 
+        than the population count.
+    gamma_mode: str, default: 'population'
+        How gamma is computed. 
+        'population': as fomo does, the group's positive labels as a 
+        fraction of all samples for FNR, and one minus that for FPR. This 
+        shrinks the deviations of small groups. 
+        'group': as subgroup_loss does for reporting, the fraction of the 
+        group's samples with positive (FNR) or negative (FPR) labels.
+
+    The grouping, gamma and abs_val keyword arguments that FomoClassifier 
+    passes to its fairness metrics override these defaults.
+    """
+    def __init__(
+        self, 
+        metric='FNR', 
+        grouping='intersectional', 
+        use_gamma=True, 
+        abs_val=True,
+        gamma_mode='population'
+    ):
+        if metric not in ('FPR','FNR'):
+            raise ValueError(f'metric={metric} must be "FPR" or "FNR"')
+        if gamma_mode not in ('population','group'):
+            raise ValueError(
+                f'gamma_mode={gamma_mode} must be "population" or "group"'
+            )
+        self.metric = metric
+        self.grouping = grouping
+        self.use_gamma = use_gamma
+        self.abs_val = abs_val
+        self.gamma_mode = gamma_mode
+        self.__name__ = f'subgroup_{metric}_scorer'
+        self._cache_key = None
+
+    def _prepare(self, X_protected, y_true, weights, grouping):
+        """Precompute the group layout and buffers for this data."""
+        key = (fingerprint(X_protected, y_true, weights), grouping)
+        if key not in _layout_cache:
+            groups = list(X_protected.columns)
+            keys, order, bounds = group_layout(X_protected, groups, grouping)
+            yt = np.asarray(y_true, dtype=float)
+            _layout_cache.clear()
+            _layout_cache[key] = (
+                keys, 
+                order, 
+                bounds, 
+                yt, 
+                yt[order], 
+                None if weights is None else np.asarray(weights, dtype=float)[order]
+            )
+        (
+            self._keys, 
+            self._order, 
+            self._bounds, 
+            self._y_true, 
+            self._y_true_sorted, 
+            self._weights_sorted
+        ) = _layout_cache[key]
+        # gamma depends only on the labels, so it is fixed for this data
+        n_pos = np.zeros(len(self._keys))
+        for i, (s, e) in enumerate(zip(self._bounds[:-1], self._bounds[1:])):
+            n_pos[i] = self._y_true_sorted[s:e].sum()
+        if self.gamma_mode == 'population':
+            pos_frac = n_pos/len(self._y_true)
+        else:
+            pos_frac = n_pos/np.diff(self._bounds)
+        self._gamma = 1 - pos_frac if self.metric == 'FPR' else pos_frac
+        self._y_pred_sorted = np.empty(len(self._order))
+        self._base = np.empty(N_RATES)
+        self._rates = np.empty((len(self._keys), N_RATES))
+        self._deviations = np.empty(len(self._keys))
+
+    def __call__(
+        self, 
+        estimator, 
+        X, 
+        y_true, 
+        groups=None, 
+        X_protected=None, 
+        weights=None,
+        grouping=None,
+        abs_val=None,
+        gamma=None
+    ):
+        assert isinstance(X, pd.DataFrame), "X should be a dataframe"
+        assert groups is not None or X_protected is not None, "groups or X_protected must be defined."
+        grouping = self.grouping if grouping is None else grouping
+
+        if groups is None:
+            assert X_protected is not None, "cannot define both groups and X_protected"
+            cache_key = (X_protected, y_true, weights, (None, grouping))
+        else:
+            assert X_protected is None, "cannot define both groups and X_protected"
+            cache_key = (X, y_true, weights, (tuple(groups), grouping))
+
+        # the cache holds references to the data, so identity checks are safe
+        if self._cache_key is None or any(
+            a is not b for a,b in zip(self._cache_key[:3], cache_key[:3])
+        ) or self._cache_key[3] != cache_key[3]:
+            self._prepare(
+                X_protected if groups is None else X[list(groups)], 
+                y_true, 
+                weights,
+                grouping
+            )
+            self._cache_key = cache_key
+
+        y_pred = estimator.predict_proba(X)[:,1]
+        return self.max_loss(
+            y_pred, 
+            abs_val=self.abs_val if abs_val is None else abs_val,
+            use_gamma=self.use_gamma if gamma is None else gamma
+        )
+
+    def max_loss(self, y_pred, abs_val=True, use_gamma=True):
+        """Returns the largest subgroup deviation of y_pred on the cached data."""
+        col = RATE_FPR if self.metric == 'FPR' else RATE_FNR
+        base_loss = fused_rates(self._y_true, y_pred, out=self._base)[col]
+        if self._y_pred_sorted.dtype != y_pred.dtype:
+            # e.g. XGBoost predicts float32
+            self._y_pred_sorted = np.empty(len(self._order), dtype=y_pred.dtype)
+        np.take(y_pred, self._order, out=self._y_pred_sorted)
+        rates = group_rates(
+            self._y_true_sorted, 
+            self._y_pred_sorted, 
+            self._bounds, 
+            self._weights_sorted, 
+            out=self._rates
+        )
+        dev = self._deviations
+        np.subtract(rates[:,col], base_loss, out=dev)
+        if use_gamma:
+            np.multiply(dev, self._gamma, out=dev)
+        if self._weights_sorted is not None:
+            np.multiply(dev, rates[:,RATE_WEIGHT], out=dev)
+        if abs_val:
+            np.abs(dev, out=dev)
+        return max(0.0, dev.max()) if len(dev) else 0.0
@@ -1,14 +1,16 @@
-import pandas as pd
 from sklearn.model_selection import train_test_split
 from sklearn.utils import resample
 import pickle
 import fomo_estimator
+from base_model import preprocessor_cache
+from utils import read_mitigate_dataset
 
 def mitigate_disparity(
     dataset: str,
     protected_features: list[str],
     starting_point: str|None = None,
-    save_file: str = 'estimator.pkl'
+    save_file: str = 'estimator.pkl',
+    history_file: str = 'history.bin'
 ):
     """
     “mitigate_disparity.py” takes in a model development dataset (training and test datasets) that your algorithm has not seen before and generates a new, optimally fair/debiased model that can be used to make new predictions.
@@ -28,6 +30,10 @@ def mitigate_disparity(
         Optionally start from a checkpoint file with this name.
     save_file: str, default: estimator.pkl
         The name of the saved estimator. 
+    history_file: str, default: history.bin
+        The name of the file that the population of each generation is 
+        written to. It is overwritten, unless resuming from starting_point. 
+        Read it with `fomo_estimator.load_history`. 
 
     Returns
     -------
@@ -39,23 +45,30 @@ def mitigate_disparity(
     print('dataset:',dataset)
     print('protected_features:',protected_features)
 
-    df = pd.read_csv(dataset, index_col=False)
+    df = read_mitigate_dataset(dataset)
     X = df.drop(columns=['binary outcome', 'sample weights'],
                 axis=1,
                 errors='ignore'
                 )
     y = df['binary outcome']
     est = fomo_estimator.est
+    termination = fomo_estimator.termination
+    termination.reset()
 
-    est.fit(
-        X,
-        y,
-        protected_features=list(protected_features), 
-        termination=fomo_estimator.termination,
-        starting_point=starting_point,
-        save_history=True,
-        checkpoint=True
-    )
+    # fitted preprocessing is shared by the worker processes during fit
+    with preprocessor_cache():
+        est.fit(
+            X,
+            y,
+            protected_features=list(protected_features), 
+            termination=termination,
+            starting_point=starting_point,
+            callback=fomo_estimator.HistoryCallback(
+                history_file, 
+                append=starting_point is not None
+            ),
+            checkpoint=True
+        )
     print('saving estimator to',save_file,'...')
     with open(save_file, 'wb') as of:
         pickle.dump(est, of)
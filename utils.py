@@ -1,5 +1,6 @@
 import numpy as np
 import pandas as pd
+import hashlib
 
 def squash_array(x):
     x[x<0.0] == 0.0
@@ -33,16 +34,70 @@ def category_diff(cat1, cat2):
     else:
         return False
 
+measure_dtypes = {
+    'model prediction': np.float32,
+    'sample weights': np.float32,
+    'binary outcome': np.int8,
+    'model label': np.int8
+}
+
+def read_measure_dataset(dataset):
+    """Reads a measure_disparity dataset with compact dtypes.
+
+    Predictions and weights are stored as float32, outcomes and labels as 
+    int8, and all other (demographic) columns as categoricals.
+    """
+    columns = pd.read_csv(dataset, nrows=0).columns
+    dtypes = {c: measure_dtypes.get(c, 'category') for c in columns}
+    return pd.read_csv(dataset, dtype=dtypes)
+
+def read_mitigate_dataset(dataset):
+    """Reads a mitigate_disparity dataset with compact dtypes.
+
+    The outcome is stored as int8, floating point features as float32 and 
+    integer features as the smallest integer type that holds them.
+    """
+    df = pd.read_csv(dataset, index_col=False)
+    for c in df.columns:
+        if c == 'binary outcome':
+            df[c] = df[c].astype(np.int8)
+        elif pd.api.types.is_float_dtype(df[c]):
+            df[c] = df[c].astype(np.float32)
+        elif pd.api.types.is_integer_dtype(df[c]):
+            df[c] = pd.to_numeric(df[c], downcast='integer')
+    return df
+
+def fingerprint(*data):
+    """Returns a hash of the contents of dataframes, series or arrays."""
+    h = hashlib.sha1()
+    for d in data:
+        if d is None:
+            h.update(b'None')
+            continue
+        if isinstance(d, pd.DataFrame):
+            h.update(str(list(d.columns)).encode())
+        elif not isinstance(d, pd.Series):
+            d = pd.Series(np.asarray(d).ravel())
+        h.update(pd.util.hash_pandas_object(d, index=True).values.tobytes())
+    return h.hexdigest()
+
 def get_groups(df, groups, grouping):
     """Map data to an existing set of categories."""
+    # as groupby().groups does, intersectional groups of several columns keep 
+    # missing values (e.g. (nan, 'x')), while single columns and marginal 
+    # groups drop them
     if grouping=='intersectional':
-        group_ids = df.groupby(groups).groups
+        dropna = len(groups) == 1
+        group_ids = {
+            k:df.index[v] 
+            for k,v in df.groupby(groups, observed=True, dropna=dropna).indices.items()
+        }
     elif grouping=='marginal':
         group_ids = {}
         for g in groups:
-            grp = df.groupby(g).groups
+            grp = df.groupby(g, observed=True).indices
             for k,v in grp.items():
-                group_ids[(g,k)] = v
+                group_ids[(g,k)] = df.index[v]
     return group_ids
 
 def categorize(X, y, groups, grouping,
@@ -65,13 +120,13 @@ def categorize(X, y, groups, grouping,
         n_bins=len(bins)
 
 
-    df = X[groups].copy()
-    df.loc[:,'interval'], retbins = pd.cut(y, bins, 
-                                           include_lowest=True,
-                                           retbins=True
-                                          )
+    # group X's columns in place rather than copying X[groups]
+    intervals = pd.Series(
+        pd.cut(y, bins, include_lowest=True), 
+        index=X.index
+    )
     categories = {}
-    group_ids = get_groups(df, groups, grouping)
+    group_ids = get_groups(X, groups, grouping)
     # group_ids = df.groupby(groups).groups
 
     min_grp_size = gamma*len(X) 
@@ -80,7 +135,8 @@ def categorize(X, y, groups, grouping,
         # filter groups smaller than gamma*len(X)
         if len(i) <= min_grp_size:
             continue
-        for interval, j in df.loc[i].groupby('interval').groups.items():
+        dfi = intervals.loc[i]
+        for interval, j in dfi.groupby(dfi, observed=True).groups.items():
             # filter categories smaller than alpha*gamma*len(X)/n_bins
             if len(j) > min_cat_size:
                 categories[group + (interval,)] = j